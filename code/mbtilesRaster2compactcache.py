@@ -39,19 +39,54 @@
 # Changeset
 # Version 1.0.0 ltbam
 import argparse
+import array
 import sqlite3
 import os
 import struct
+import sys
 import shutil
 import datetime
 import re
-import io
 import time
 import math
+import mmap
+import queue
+import urllib.parse
 
 from joblib import Parallel, delayed
-from threading import Lock, get_ident, Thread
+from threading import get_ident, Thread
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, as_completed, wait
 import multiprocessing
+from collections import OrderedDict, defaultdict
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+
+def _open_ro(path):
+    """
+    Opens the MBTiles database as an immutable read-only connection.
+
+    :param path: path to the .mbtiles file
+    :return: configured sqlite3 connection
+    """
+    path = os.path.abspath(path).replace("\\", "/")
+    if not path.startswith("/"):
+        # drive letter path
+        path = "/" + path
+    # empty authority, a UNC path keeps its leading // as file:////server/share
+    uri = "file://" + urllib.parse.quote(path, safe="/:") + "?mode=ro&immutable=1"
+    # autocommit: no BEGIN/COMMIT wrapped around the SELECTs
+    database = sqlite3.connect(uri, uri=True, isolation_level=None)
+    database.execute("PRAGMA query_only=1")
+    # map the file instead of issuing a read per page
+    database.execute("PRAGMA mmap_size={}".format(1 << 32))
+    database.execute("PRAGMA cache_size=-131072")
+    database.execute("PRAGMA temp_store=MEMORY")
+    return database
 
 
 class Bundle:
@@ -59,17 +94,30 @@ class Bundle:
     BSZ = 128
     # Tiles per bundle
     BSZ2 = BSZ ** 2
+    # BSZ is a power of two: position inside the bundle and bundle origin masks
+    MASK = BSZ - 1
+    CLR = ~MASK
     # Index size in bytes
     IDXSZ = BSZ2 * 8
     # Max size
     M = 2 ** 40
+    # Max preallocation step of the bundle file
+    ALLOC = 4 * 2 ** 20
+    # Precompiled layouts: header, tile size / max record size, file size
+    _HDR = struct.Struct("<4I3Q6I")
+    _SZ = struct.Struct("<I")
+    _OFS = struct.Struct("<Q")
 
     def __init__(self, file_name):
         self.file_name = file_name
         self.curr_max = 0
         self.curr_offset = 0
-        self.curr_index = []
-        self.lock = Lock()
+        self.allocated = 0
+        # end of the data when the bundle was opened
+        self.open_offset = 0
+        self.curr_index = array.array('Q')
+        # one byte per index slot, set when the slot changed since open()
+        self.dirty = bytearray()
         self.fd = None
         regex = r"\_alllayers\\L(..)"
         self.level = re.findall(regex, self.file_name)[0]
@@ -84,24 +132,23 @@ class Bundle:
         # print("t {0}: initializing: {1}".format(get_ident(), self.file_name))
         self.fd = open(self.file_name, "wb")
         # Empty bundle file header, lots of magic numbers
-        header = struct.pack("<4I3Q6I",
-                             3,  # Version
-                             Bundle.BSZ2,  # numRecords
-                             0,  # maxRecord Size
-                             5,  # Offset Size
-                             0,  # Slack Space
-                             64 + Bundle.IDXSZ,  # File Size
-                             40,  # User Header Offset
-                             20 + Bundle.IDXSZ,  # User Header Size
-                             3,  # Legacy 1
-                             16,  # Legacy 2
-                             Bundle.BSZ2,  # Legacy 3
-                             5,  # Legacy 4
-                             Bundle.IDXSZ  # Index Size
-                             )
+        header = Bundle._HDR.pack(3,  # Version
+                                  Bundle.BSZ2,  # numRecords
+                                  0,  # maxRecord Size
+                                  5,  # Offset Size
+                                  0,  # Slack Space
+                                  64 + Bundle.IDXSZ,  # File Size
+                                  40,  # User Header Offset
+                                  20 + Bundle.IDXSZ,  # User Header Size
+                                  3,  # Legacy 1
+                                  16,  # Legacy 2
+                                  Bundle.BSZ2,  # Legacy 3
+                                  5,  # Legacy 4
+                                  Bundle.IDXSZ  # Index Size
+                                  )
         self.fd.write(header)
         # Write empty index.
-        self.fd.write(struct.pack("<{}Q".format(Bundle.BSZ2), *((0,) * Bundle.BSZ2)))
+        self.fd.write(b"\x00" * Bundle.IDXSZ)
         self.fd.close()
         self.fd = None
         # time.sleep(0.2)
@@ -112,24 +159,79 @@ class Bundle:
         self.fd = open(self.file_name, "r+b")
         # Read the current max record size
         self.fd.seek(8)
-        self.curr_max = int(struct.unpack("<I", self.fd.read(4))[0])
-        # Read the index as longs in a list
+        self.curr_max = Bundle._SZ.unpack(self.fd.read(4))[0]
+        # Read the index as unsigned 64 bit values
         self.fd.seek(64)
-        self.curr_index = list(struct.unpack("<{}Q".format(Bundle.BSZ2),
-                                             self.fd.read(Bundle.IDXSZ)))
-        # Go to end
-        self.fd.seek(0, os.SEEK_END)
-        self.curr_offset = self.fd.tell()
-
-    def write_tile(self, tile, tile_size, row, col):
-        self.fd.write(struct.pack("<I", tile_size))
-        self.fd.write(tile)
-        self.curr_offset += 4
-        # Update the index, row major
-        self.curr_index[(row % Bundle.BSZ) * Bundle.BSZ + col % Bundle.BSZ] = self.curr_offset + (tile_size << 40)
-        self.curr_offset += tile_size
-        # Update the current bundle max tile size
-        self.curr_max = max(self.curr_max, tile_size)
+        self.curr_index = array.array('Q')
+        self.curr_index.frombytes(self.fd.read(Bundle.IDXSZ))
+        if sys.byteorder != "little":
+            self.curr_index.byteswap()
+        self.dirty = bytearray(Bundle.BSZ2)
+        # Go to the end of the data, the file itself can be preallocated further
+        self.fd.seek(24)
+        self.curr_offset = Bundle._OFS.unpack(self.fd.read(8))[0]
+        self.fd.seek(self.curr_offset)
+        self.open_offset = self.curr_offset
+        self.allocated = os.fstat(self.fd.fileno()).st_size
+
+    def reserve(self, size):
+        """
+        Preallocates the file so that size more bytes fit after the current
+        offset, instead of growing it on every append. The step follows what the
+        bundle received since it was opened, up to ALLOC, so that a bundle evicted
+        and reopened for a few tiles does not get a large tail that cleanup()
+        truncates right away. On file systems without native support glibc
+        emulates posix_fallocate by writing zeros, the step bounds that cost to
+        the size of the data written.
+
+        :param size: number of bytes about to be written
+        """
+        end = self.curr_offset + size
+        if end <= self.allocated or not hasattr(os, "posix_fallocate"):
+            return
+        new_size = end + min(Bundle.ALLOC, end - self.open_offset)
+        try:
+            os.posix_fallocate(self.fd.fileno(), self.allocated, new_size - self.allocated)
+        except OSError:
+            # only an optimization, the writes extend the file anyway
+            return
+        self.allocated = new_size
+
+    @staticmethod
+    def pack_slots(slots, offsets, sizes, base_offset, index_out, dirty_out):
+        """
+        Fills the index slots of a block of tiles appended at base_offset.
+
+        :param slots: index slot of each tile
+        :param offsets: offset of each tile data in the block
+        :param sizes: tile sizes in bytes
+        :param base_offset: file offset where the block starts
+        :param index_out: bundle index to update
+        :param dirty_out: dirty slots map to update
+        :return: max tile size in the block
+        """
+        max_size = 0
+        for slot, offset, size in zip(slots, offsets, sizes):
+            index_out[slot] = base_offset + offset + (size << 40)
+            dirty_out[slot] = 1
+            if size > max_size:
+                max_size = size
+        return max_size
+
+    def write_block(self, buf, slots, offsets, sizes):
+        """
+        Appends a block of tiles assembled by a worker with a single write
+
+        :param buf: size prefixed tiles, one after the other
+        :param slots: index slot of each tile, array('i')
+        :param offsets: offset of each tile data in buf, array('q')
+        :param sizes: tile sizes in bytes, array('i')
+        """
+        self.reserve(len(buf))
+        batch_max = Bundle.pack_slots(slots, offsets, sizes, self.curr_offset, self.curr_index, self.dirty)
+        self.curr_max = max(self.curr_max, batch_max)
+        self.fd.write(buf)
+        self.curr_offset += len(buf)
 
     def listMissingTiles(self):
         files = []
@@ -184,102 +286,268 @@ class Bundle:
         """
         Updates header and closes the current bundle
         """
-        # Update the max rec size and file size, then close the file
-        self.fd.seek(8)
-        self.fd.write(struct.pack("<I", self.curr_max))
-        self.fd.seek(24)
-        self.fd.write(struct.pack("<Q", self.curr_offset))
-        self.fd.seek(64)
-        self.fd.write(struct.pack("<{}Q".format(Bundle.BSZ2), *self.curr_index))
+        # Drop the unused preallocated space
+        self.fd.flush()
+        self.fd.truncate(self.curr_offset)
+        index = self.curr_index
+        if sys.byteorder != "little":
+            index = array.array('Q', index)
+            index.byteswap()
+        index = memoryview(index).cast('B')
+        # Update the max rec size, file size and the changed runs of index slots
+        # through a mapping of the header, then close the file
+        with mmap.mmap(self.fd.fileno(), 64 + Bundle.IDXSZ) as header:
+            Bundle._SZ.pack_into(header, 8, self.curr_max)
+            Bundle._OFS.pack_into(header, 24, self.curr_offset)
+            start = self.dirty.find(1)
+            while start != -1:
+                end = self.dirty.find(0, start)
+                if end == -1:
+                    end = Bundle.BSZ2
+                header[64 + start * 8:64 + end * 8] = index[start * 8:end * 8]
+                start = self.dirty.find(1, end)
+        self.dirty = bytearray()
+        # the bundle is not read back during the export, start its writeback and
+        # drop it from the page cache instead of evicting the pages still in use
+        if hasattr(os, "posix_fadvise"):
+            os.posix_fadvise(self.fd.fileno(), 0, 0, os.POSIX_FADV_DONTNEED)
         self.fd.close()
         self.fd = None
         # print("t {0}: cleaned up: {1}".format(get_ident(), self.file_name))
         # time.sleep(0.2)
 
 
+class BundlePool:
+    """
+    Keeps bundles open across batches. When too many files are open the least
+    recently used bundle is written back and closed.
+
+    A pool belongs to a single writer thread and is not thread safe.
+    """
+    # Open files limit used when the platform does not report one (Windows CRT)
+    DEFAULT_MAX_OPEN = 512
+
+    def __init__(self, max_open=None):
+        self.max_open = max_open or BundlePool.max_open_files() // 2
+        self.bundles = OrderedDict()
+
+    @staticmethod
+    def max_open_files():
+        if resource is None:
+            return BundlePool.DEFAULT_MAX_OPEN
+        soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+        if soft == resource.RLIM_INFINITY or soft <= 0:
+            return BundlePool.DEFAULT_MAX_OPEN
+        return soft
+
+    def get(self, file_name):
+        """
+        Returns the open bundle for this file, opening or creating it if needed.
+
+        :param file_name: bundle file path
+        :return: open Bundle
+        """
+        bundle = self.bundles.get(file_name)
+        if bundle is not None:
+            self.bundles.move_to_end(file_name)
+            return bundle
+
+        while len(self.bundles) >= self.max_open:
+            name, evicted = self.bundles.popitem(last=False)
+            evicted.cleanup()
+
+        bundle = Bundle(file_name)
+        bundle.open()
+        self.bundles[file_name] = bundle
+        return bundle
+
+    def flush_all(self):
+        """
+        Writes back and closes every open bundle.
+        """
+        while self.bundles:
+            name, bundle = self.bundles.popitem(last=False)
+            bundle.cleanup()
+
+
 class BundleManager:
-    b_list = {}
+    # read-only connection of a pool worker process
+    database = None
+    # one queue and one pool per writer thread, a bundle always goes to the same writer
+    shards = []
+    pools = []
+    writers = []
+    # exceptions raised in the writer threads
+    errors = []
 
     def __init__(self):
         pass
 
     @staticmethod
-    def process(start, results, index, arguments):
-        mb_tile_file = arguments.source
-        cache_output_folder = arguments.destination
-        cache_output_folder = os.path.join(cache_output_folder, "A3_MyCachedService", "Layers", "_alllayers")
+    def init_worker(mb_tile_file):
+        """
+        Process pool initializer, every worker process reads through its own connection.
+
+        :param mb_tile_file: path to the .mbtiles file
+        """
+        BundleManager.database = _open_ro(mb_tile_file)
+
+    @staticmethod
+    def process(start, end, arguments):
+        """
+        Reads one window of the tiles table and groups it per bundle, runs in a
+        pool process.
+
+        :param start: rowid after which the window starts
+        :param end: last rowid of the window
+        :param arguments: commandline arguments
+        :return: (number of treated tiles, {bundle file: (buf, slots, offsets, sizes)})
+        """
         max_level_param = arguments.max_level
-        sql = 'SELECT * FROM tiles where rowid > {0} limit {1}'.format(start, Application.rec_per_request)
+        # constant statement text, sqlite reuses the prepared statement across windows
+        sql = 'SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles WHERE rowid > ? AND rowid <= ?'
+        params = (start, end)
         if max_level_param != -1:
-            sql = 'SELECT * FROM (SELECT zoom_level, tile_column, tile_row, tile_data FROM tiles where rowid > {0} limit ' \
-                  '{1}) WHERE zoom_level <= {2}'.format(start, Application.rec_per_request, max_level_param)
+            sql += ' AND zoom_level <= ?'
+            params += (max_level_param,)
+
+        row_cursor = BundleManager.database.cursor()
+        row_cursor.execute(sql, params)
+        # stream the rows into the blocks, the window is never held as a list of rows
+        result = BundleManager.process_rows(row_cursor, arguments)
+        row_cursor.close()
 
-        # print(sql)
+        return result
+
+    @staticmethod
+    def process_rows(rows, arguments):
+        """
+        Assembles a batch of tiles rows into one in-memory block per bundle, so
+        that the writer appends each bundle with a single write.
 
-        database = sqlite3.connect(mb_tile_file)
-        row_cursor = database.cursor()
-        row_cursor.execute(sql)
+        :param rows: iterable of (zoom_level, tile_column, tile_row, tile_data), list or cursor
+        :param arguments: commandline arguments
+        :return: (number of treated tiles, {bundle file: (buf, slots, offsets, sizes)})
+        """
+        cache_output_folder = arguments.destination
+        cache_output_folder = os.path.join(cache_output_folder, "A3_MyCachedService", "Layers", "_alllayers")
+        # per zoom level lookups, instead of a join and a power per tile
+        level_paths = [os.path.join(cache_output_folder, 'L' + '{:02d}'.format(z)) for z in range(32)]
+        max_rows = [(1 << z) - 1 for z in range(32)]
+        bsz = Bundle.BSZ
+        mask = Bundle.MASK
+        pack_size = Bundle._SZ.pack
         current_tile = 0
-        data = {}
-        for rec in row_cursor:
+        # size prefixed tiles, index slots, tile offsets in the block and sizes per bundle
+        data = defaultdict(lambda: (bytearray(), array.array('i'), array.array('q'), array.array('i')))
+        for rec in rows:
             current_tile += 1
-            level = 'L' + '{:02d}'.format(rec[0])
-            output_path = os.path.join(cache_output_folder, level)
-            max_rows = 2 ** int(rec[0]) - 1
-            tile = io.BytesIO(rec[3]).getvalue()
-            row = max_rows - int(rec[2])
-            col = int(rec[1])
+            zoom_level = rec[0]
+            output_path = level_paths[zoom_level]
+            tile = rec[3]
+            row = max_rows[zoom_level] - rec[2]
+            col = rec[1]
 
             # resolve the bundle
-            start_row = int(row / Bundle.BSZ) * Bundle.BSZ
-            start_col = int(col / Bundle.BSZ) * Bundle.BSZ
+            start_row = row & Bundle.CLR
+            start_col = col & Bundle.CLR
             bname = "R{:04x}C{:04x}".format(start_row, start_col)
             fname = os.path.join(output_path, bname + ".bundle")
 
-            if fname not in data:
-                data[fname] = []
-            data[fname].append([fname, tile, row, col])
+            buf, slots, offsets, sizes = data[fname]
+            tile_size = len(tile)
+            buf += pack_size(tile_size)
+            offsets.append(len(buf))
+            buf += tile
+            # row major
+            slots.append((row & mask) * bsz + (col & mask))
+            sizes.append(tile_size)
 
-        row_cursor.close()
-        database.close()
+        # the default factory can not be pickled back to the parent process
+        return current_tile, dict(data)
 
-        BundleManager.add_tiles(data, arguments.lock)
+    @staticmethod
+    def start_writers(w_jobs):
+        """
+        Starts the writer threads, each one owning the bundles hashed to its shard.
 
-        results[index] = current_tile
+        :param w_jobs: number of writer threads
+        """
+        max_open = max(1, BundlePool.max_open_files() // 2 // w_jobs)
+        BundleManager.errors = []
+        for i in range(w_jobs):
+            shard = queue.Queue(maxsize=2)
+            pool = BundlePool(max_open)
+            writer = Thread(target=BundleManager.write_bundles, args=(shard, pool))
+            BundleManager.shards.append(shard)
+            BundleManager.pools.append(pool)
+            BundleManager.writers.append(writer)
+            writer.start()
 
     @staticmethod
-    def add_tiles(data, lock):
-        for bundle in data.keys():
+    def stop_writers():
+        """
+        Waits for the writer threads to drain their queue and write back their bundles.
+        Errors of the writers are kept, see check_writers.
+        """
+        for shard in BundleManager.shards:
+            shard.put(None)
+        for writer in BundleManager.writers:
+            writer.join()
+        BundleManager.shards = []
+        BundleManager.pools = []
+        BundleManager.writers = []
 
-            # init list one bundle/object at a time
-            with lock:
-                if bundle not in BundleManager.b_list:
-                    BundleManager.b_list[bundle] = Bundle(bundle)
-
-            # lock write operation on the bundle per thread
-            # print("t {0}: enter lock: {1}".format(get_ident(), bundle))
-            with BundleManager.b_list[bundle].lock:
-                if not BundleManager.b_list[bundle].fd:
-                    BundleManager.b_list[bundle].open()
-                for t in data[bundle]:
-                    tile = t[1]
-                    tile_size = len(t[1])
-                    row = t[2]
-                    col = t[3]
-                    # print("add tile row:{0} col:{1} buff:{2} path:{3}".format(row, col, tile_size, bundle))
-                    # Open or create it, seek to end of bundle file
-                    BundleManager.b_list[bundle].write_tile(tile, tile_size, row, col)
-
-                BundleManager.b_list[bundle].cleanup()
-                # free written bundle from mem.
-                del BundleManager.b_list[bundle]
-
-            # print("t {0}: left lock: {1}".format(get_ident(), bundle))
+    @staticmethod
+    def check_writers():
+        """
+        Re-raises the first exception raised in a writer thread.
+        """
+        if BundleManager.errors:
+            raise BundleManager.errors[0]
+
+    @staticmethod
+    def write_bundles(shard, pool):
+        """
+        Writer thread loop, appends the queued tiles to the bundles of its shard.
+
+        :param shard: queue of [(bundle file, (buf, slots, offsets, sizes)), ...]
+        :param pool: bundles owned by this writer
+        """
+        try:
+            while True:
+                batch = shard.get()
+                if batch is None:
+                    break
+                for bundle, block in batch:
+                    pool.get(bundle).write_block(*block)
+        except Exception as e:
+            BundleManager.errors.append(e)
+            # keep consuming until the end marker so that producers never block on this shard
+            while shard.get() is not None:
+                pass
+        finally:
+            try:
+                pool.flush_all()
+            except Exception as e:
+                BundleManager.errors.append(e)
+
+    @staticmethod
+    def add_tiles(data):
+        BundleManager.check_writers()
+        shards = BundleManager.shards
+        batches = [[] for shard in shards]
+        for bundle in data.keys():
+            batches[hash(bundle) % len(shards)].append((bundle, data[bundle]))
+        for shard, batch in zip(shards, batches):
+            if batch:
+                shard.put(batch)
 
     @staticmethod
     def add_tile(output_path, byte_buffer, row, col=None):
         """
-        Add this tile to the output cache
+        Add this tile to the output cache, the bundle is written and closed
+        before returning. Not meant to run next to the writer threads of an export.
 
         :param output_path: path where the bundle is.
         :param byte_buffer: input tile as byte buffer
@@ -288,31 +556,23 @@ class BundleManager:
         """
 
         # Read the tile data
-        tile = io.BytesIO(byte_buffer).getvalue()
+        tile = bytes(byte_buffer)
         tile_size = len(tile)
 
         # resolve the bundle
-        start_row = int((row / Bundle.BSZ)) * Bundle.BSZ
-        start_col = int((col / Bundle.BSZ)) * Bundle.BSZ
+        start_row = row & Bundle.CLR
+        start_col = col & Bundle.CLR
         bname = "R{:04x}C{:04x}".format(start_row, start_col)
         fname = os.path.join(output_path, bname + ".bundle")
 
         print("add tile row:{0} col:{1} buff:{2} path:{3}".format(row, col, len(byte_buffer), output_path))
 
-        # should be thread safe
-        if not fname in BundleManager.b_list:
-            BundleManager.b_list[fname] = Bundle(fname)
-
-        # lock write operation on the bundle per thread
-        with BundleManager.b_list[fname].lock:
-            print("t {0}: enter lock: {1}".format(get_ident(), fname))
-            # Open or create it, seek to end of bundle file
-            if not BundleManager.b_list[fname].fd:
-                BundleManager.b_list[fname].open()
-
-            BundleManager.b_list[fname].write_tile(tile, tile_size, row, col)
-            BundleManager.b_list[fname].cleanup()
-            print("t {0}: left lock: {1}".format(get_ident(), fname))
+        buf = bytearray(Bundle._SZ.pack(tile_size)) + tile
+        slot = (row & Bundle.MASK) * Bundle.BSZ + (col & Bundle.MASK)
+        bundle = Bundle(fname)
+        bundle.open()
+        bundle.write_block(buf, array.array('i', [slot]), array.array('q', [4]), array.array('i', [tile_size]))
+        bundle.cleanup()
 
         return fname
 
@@ -321,6 +581,8 @@ class Application:
     # Number of concurrent jobs for the export
     p_jobs = multiprocessing.cpu_count()
     #p_jobs = 1
+    # Number of bundle writer threads
+    w_jobs = multiprocessing.cpu_count()
     # Records per request to be treated by a single thread
     rec_per_request = 500000
 
@@ -353,6 +615,16 @@ class Application:
 
         return arguments
 
+    @staticmethod
+    def print_progress(treated_tiles, number_of_tiles, start_time):
+        if treated_tiles > 0:
+            current_tile_time = (datetime.datetime.now() - start_time).total_seconds() / treated_tiles * (
+                        number_of_tiles - treated_tiles) / 3600
+            print('Treated tiles {:3.2f}% - {:3.2f} hours left.'.format(treated_tiles / number_of_tiles * 100,
+                                                                        current_tile_time))
+        else:
+            print('Treated tiles {:3.2f}'.format(treated_tiles))
+
 
 #
 # Entry point, start the Application
@@ -360,7 +632,6 @@ class Application:
 def main():
     app = Application()
     arguments = app.get_arguments()
-    arguments.lock = Lock()
 
     # parse parameters
     mb_tile_file = arguments.source
@@ -377,62 +648,61 @@ def main():
     for lvl in range(max_level_param + 1):
         level = 'L' + '{:02d}'.format(lvl)
         dir = os.path.join(cache_output_folder, level)
-        if not os.path.exists(dir):
-            os.makedirs(dir)
+        os.makedirs(dir, exist_ok=True)
 
     # get max records based on rowid
-    database = sqlite3.connect(mb_tile_file)
+    database = _open_ro(mb_tile_file)
     row_cursor = database.cursor()
     number_of_tiles = row_cursor.execute('SELECT max(rowid) FROM tiles').fetchone()[0]
     database.close()
-    start = 0
     treated_tiles = 0
     start_time = datetime.datetime.now()
-    #if number_of_tiles > app.rec_per_request:
-    #    app.rec_per_request = int(number_of_tiles ** 0.65)
-
-    print('Exporting {0} rows at a time within {1} threads.\t'.format(app.rec_per_request, app.p_jobs))
-    while treated_tiles < number_of_tiles:
-        t_arr = {}
-        r_arr = {}
-        
-        # starting threads
-        for i in range(app.p_jobs):
-            t_arr[i] = Thread(target=BundleManager.process,
-                              args=(start + (app.rec_per_request * i), r_arr, i, arguments))
-            t_arr[i].start()
-            
-        # wait for threads before next round
-        for i in range(app.p_jobs):
-            t_arr[i].join()
-
-        for res in r_arr:
-            treated_tiles += r_arr[res]
-            start += app.rec_per_request
-
-        if treated_tiles > 0:
-            current_tile_time = (datetime.datetime.now() - start_time).total_seconds() / treated_tiles * (
-                        number_of_tiles - treated_tiles) / 3600
-            print('Treated tiles {:3.2f}% - {:3.2f} hours left.'.format(treated_tiles / number_of_tiles * 100,
-                                                                        current_tile_time))
-        else:
-            print('Treated tiles {:3.2f}'.format(treated_tiles))
-
-        print("Checking contiguous tiles in Bundle")
-        for path, subdirs, files in os.walk(cache_output_folder):
-            for name in files:
-                if "bundle" in name:
-                    print("checking bundle {}".format(name))
-                    bdl = Bundle(os.path.join(path, name))
-                    bdl.open()
-                    results = bdl.listMissingTiles()
-                    for res in results:
-                        print("Missing contiguous tile: level {}, row {}, col {}".format(res["lvl"], res["row"],
-                                                                                         res["col"]))
-                    # close bundle without writing anything
-                    bdl.fd.close()
-                    bdl.fd = None
 
+    print('Exporting {0} rows at a time within {1} processes.\t'.format(app.rec_per_request, app.p_jobs))
+    # p_jobs processes read and group the rowid windows, the main process hands
+    # the groups over to w_jobs writer threads appending to the bundles they own
+    BundleManager.start_writers(app.w_jobs)
+    # spawn on every platform, forking next to the running writer threads is not safe
+    context = multiprocessing.get_context('spawn')
+    try:
+        with ProcessPoolExecutor(max_workers=app.p_jobs, mp_context=context,
+                                 initializer=BundleManager.init_worker, initargs=(mb_tile_file,)) as executor:
+            pending = set()
+            for start in range(0, number_of_tiles, app.rec_per_request):
+                pending.add(executor.submit(BundleManager.process, start, start + app.rec_per_request,
+                                            arguments))
+                # keep about one window per process in memory
+                if len(pending) >= app.p_jobs:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        count, data = future.result()
+                        BundleManager.add_tiles(data)
+                        treated_tiles += count
+                    app.print_progress(treated_tiles, number_of_tiles, start_time)
+
+            for future in as_completed(pending):
+                count, data = future.result()
+                BundleManager.add_tiles(data)
+                treated_tiles += count
+                app.print_progress(treated_tiles, number_of_tiles, start_time)
+    finally:
+        BundleManager.stop_writers()
+    BundleManager.check_writers()
+
+    print("Checking contiguous tiles in Bundle")
+    for path, subdirs, files in os.walk(cache_output_folder):
+        for name in files:
+            if "bundle" in name:
+                print("checking bundle {}".format(name))
+                bdl = Bundle(os.path.join(path, name))
+                bdl.open()
+                results = bdl.listMissingTiles()
+                for res in results:
+                    print("Missing contiguous tile: level {}, row {}, col {}".format(res["lvl"], res["row"],
+                                                                                     res["col"]))
+                # close bundle without writing anything
+                bdl.fd.close()
+                bdl.fd = None
 
 if __name__ == '__main__':
     main()